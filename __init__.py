@@ -1,2 +1,2 @@
 # exports for bottle_simple_admin
-from .bottle_simple_admin import Admin, url_for, render_template
+from .bottle_simple_admin import Admin, url_for, render_template, stream_template
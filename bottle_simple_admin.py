@@ -39,21 +39,134 @@ __version__ = '0.0.4'
 __license__ = 'MIT'
 
 from bottle import Bottle, redirect, abort, request
-from bottle import jinja2_template
+from bottle import TEMPLATE_PATH
+from jinja2 import Environment, FileSystemLoader
 from montydb import MontyClient, set_storage
-import json
+from montydb.errors import CollectionInvalid as MontyCollectionInvalid
+from bson import json_util
 from pymongo import MongoClient
+from pymongo.errors import CollectionInvalid, OperationFailure
 from bson import ObjectId
-from functools import wraps
+from bson.codec_options import TypeDecoder, TypeRegistry
+from functools import wraps, lru_cache
 
 import os
+import re
+import time
+import hmac
+import hashlib
+import threading
 from passlib.context import CryptContext
+from passlib.hash import pbkdf2_sha256
+from passlib.utils.binary import ab64_decode
 
-pwd_context = CryptContext(
+# wall time one password hash should take when the rounds are tuned on startup
+_HASH_TARGET_TIME = 0.05
+_HASH_MIN_ROUNDS = 10000
+
+# stored hashes with fewer than this share of the current rounds are redone on login,
+# the margin keeps the few percent the tuned rounds vary between starts from rehashing
+_HASH_REHASH_RATIO = 0.8
+
+def _build_pwd_context(rounds):
+    """_build_pwd_context(rounds) - a pbkdf2_sha256 CryptContext hashing with rounds,
+    needs_update() flags hashes made with well under rounds so they are redone on login
+    """
+    return CryptContext(
         schemes=["pbkdf2_sha256"],
         default="pbkdf2_sha256",
-        pbkdf2_sha256__default_rounds=30000
-)
+        pbkdf2_sha256__default_rounds=rounds,
+        pbkdf2_sha256__min_desired_rounds=int(rounds * _HASH_REHASH_RATIO)
+    )
+
+pwd_context = _build_pwd_context(30000)
+
+def tune_password_rounds(target_time=_HASH_TARGET_TIME, sample_rounds=_HASH_MIN_ROUNDS):
+    """
+    tune_password_rounds(target_time, sample_rounds) - time a few sample hashes
+    and return the pbkdf2 rounds which take about target_time seconds on this machine
+    """
+    hasher = pbkdf2_sha256.using(rounds=sample_rounds)
+    loops = 0
+    elapsed = 0.0
+    start = time.perf_counter()
+    while elapsed < target_time:
+        hasher.hash('x')
+        loops += 1
+        elapsed = time.perf_counter() - start
+    rounds = int(sample_rounds * loops * target_time / elapsed)
+    return max(rounds, _HASH_MIN_ROUNDS)
+
+def set_password_rounds(rounds):
+    """set_password_rounds(rounds) - hash new passwords with rounds of pbkdf2_sha256"""
+    global pwd_context
+    pwd_context = _build_pwd_context(rounds)
+
+# recently verified logins, sha256(username, password) -> (stored hash, time verified)
+# keeping the stored hash means a changed password never matches a stale entry
+_VERIFY_CACHE = {}
+_VERIFY_CACHE_TTL = 60
+_VERIFY_CACHE_SIZE = 1024
+_verify_lock = threading.Lock()
+
+def _verify_key(username, password):
+    return hashlib.sha256(f"{username}\x00{password}".encode()).digest()
+
+def _is_verified(key, hashed):
+    """_is_verified(key, hashed) - True if key was verified against hashed within the TTL"""
+    entry = _VERIFY_CACHE.get(key)
+    if entry is None:
+        return False
+    return entry[0] == hashed and time.time() - entry[1] < _VERIFY_CACHE_TTL
+
+def _remember_verified(key, hashed):
+    """_remember_verified(key, hashed) - store a successful verify, evicting stale entries"""
+    now = time.time()
+    with _verify_lock:
+        stale = [k for k, (_, ts) in _VERIFY_CACHE.items() if now - ts >= _VERIFY_CACHE_TTL]
+        for k in stale:
+            del _VERIFY_CACHE[k]
+        if len(_VERIFY_CACHE) >= _VERIFY_CACHE_SIZE:
+            # evict the oldest entry
+            del _VERIFY_CACHE[next(iter(_VERIFY_CACHE))]
+        _VERIFY_CACHE[key] = (hashed, now)
+
+
+class _ObjectIdDecoder(TypeDecoder):
+    """decode ObjectId values straight to strings, used when rendering documents"""
+    bson_type = ObjectId
+    
+    def transform_bson(self, value):
+        return str(value)
+
+_STR_ID_REGISTRY = TypeRegistry([_ObjectIdDecoder()])
+
+# documents per round-trip when streaming a collection into a page
+_VIEW_BATCH_SIZE = 200
+
+# template output pieces joined into each chunk of a streamed page
+_STREAM_BUFFER_SIZE = 64
+
+# documents per page of the collection view, ?per_page= may ask for up to the maximum
+_VIEW_PAGE_SIZE = 50
+_VIEW_MAX_PAGE_SIZE = 1000
+
+# seconds the collection names are trusted before the database is asked again
+_COLLECTIONS_TTL = 5.0
+
+# most collection schemas kept in memory by each Admin, and the seconds each is trusted
+# (other workers only see a schema saved here once their copy expires)
+_SCHEMA_CACHE_SIZE = 256
+_SCHEMA_TTL = 5.0
+
+# marks a cache miss where None is a valid cached value
+_MISSING = object()
+
+# request.environ key holding the login_check() answer for the current request
+_AUTH_ENVIRON_KEY = 'bottle_simple_admin.user'
+
+# form fields which are never written into a document
+_FORM_STRIP = frozenset(('_id', 'csrf_token'))
 
 
 # local session placeholder
@@ -61,37 +174,174 @@ _admin_session = None
 
 
 def encrypt_password(password):
-    return pwd_context.encrypt(password)
+    return pwd_context.hash(password)
 
 def check_encrypted_password(password, hashed):
     return pwd_context.verify(password, hashed)
 
+# $pbkdf2-sha256$rounds$salt$checksum, salt and checksum are in passlib's adapted base64
+_PBKDF2_HASH_RE = re.compile(r'\$pbkdf2-sha256\$(\d+)\$([./A-Za-z0-9]*)\$([./A-Za-z0-9]+)').fullmatch
+
+@lru_cache(maxsize=256)
+def _parse_pbkdf2_hash(hashed):
+    """_parse_pbkdf2_hash(hashed) - (rounds, salt, checksum) of a pbkdf2_sha256 hash, None if not one"""
+    m = _PBKDF2_HASH_RE(hashed)
+    if m is None:
+        return None
+    try:
+        return int(m.group(1)), ab64_decode(m.group(2)), ab64_decode(m.group(3))
+    except ValueError:
+        return None
+
+def check_encrypted_password_fast(password, hashed):
+    """check_encrypted_password_fast(password, hashed) - verify a pbkdf2_sha256 hash with
+    hashlib directly, any other hash goes through pwd_context
+    """
+    parsed = _parse_pbkdf2_hash(hashed)
+    if parsed is None:
+        return check_encrypted_password(password, hashed)
+    rounds, salt, expected = parsed
+    dk = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, rounds, dklen=len(expected))
+    return hmac.compare_digest(dk, expected)
+
 # hooks for database and app
 _db = None
 _app = None
 
+def _dumps(data):
+    """_dumps(data) - a document as extended JSON, BSON types such as ObjectId,
+    datetime and Decimal128 are written as {"$oid": ...} style objects
+    """
+    return json_util.dumps(data, json_options=json_util.RELAXED_JSON_OPTIONS, indent=2)
+
+def _loads(text):
+    """_loads(text) - parse extended JSON, the BSON types written by _dumps() come back typed"""
+    return json_util.loads(text)
+
 def jsonify(myjson):
     """jsonify() - makes it JSON similar to flask
     (in Bottle you don't have to do anything)
     """
     return myjson
 
+# validates the 24 hex digit string form of an ObjectId
+def _to_oid(id_):
+    """_to_oid(id_) - ObjectId from its string form, None if id_ is not a valid id"""
+    # decode the hex once and hand ObjectId its 12 bytes, which it takes without checking again
+    if len(id_) != 24:
+        return None
+    try:
+        raw = bytes.fromhex(id_)
+    except ValueError:
+        return None
+    # fromhex skips whitespace, so a short result means the id was not all hex digits
+    return ObjectId(raw) if len(raw) == 12 else None
+
+# admin route name -> (format string of the rule, names of its wildcards), see _compile_url_rules()
+_url_rules = {}
+_URL_WILDCARD = re.compile(r'<([a-zA-Z_][a-zA-Z_0-9]*)(?::[^>]*)?>')
+
+def _compile_url_rules(routes):
+    """_compile_url_rules(routes) - turn each named route rule into a format string once
+    so url_for() can build its URL without going through the router
+    """
+    for route in routes:
+        if route.name:
+            names = frozenset(_URL_WILDCARD.findall(route.rule))
+            fmt = route.rule.replace('{', '{{').replace('}', '}}')
+            fmt = _URL_WILDCARD.sub(lambda m: '{%s}' % m.group(1), fmt)
+            _url_rules[route.name] = (fmt, names)
+    _build_admin_url.cache_clear()
+
+@lru_cache(maxsize=512)
+def _build_admin_url(named_route, script_name, items):
+    """_build_admin_url(named_route, script_name, items) - URL of an admin route, memoized
+    :param items - the sorted (key, str(value)) pairs of the route arguments
+    """
+    path = _url_rules[named_route][0].format(**dict(items)).lstrip('/')
+    if script_name:
+        return '/' + script_name + '/' + path
+    return '/' + path
+
 def url_for(named_route, **kwargs):
     """url_for('route_name', key1=val1, key2=val2, ...) - returns a decorated route
              this is defined in flask! Bottle simulates it
     """
-    url = _app.get_url(named_route, **kwargs)
-    return url
+    rule = _url_rules.get(named_route)
+    if rule is None or rule[1] != kwargs.keys():
+        # not an admin route, or extra arguments which Bottle turns into a query string
+        return _app.get_url(named_route, **kwargs)
+    script_name = request.environ.get('SCRIPT_NAME', '').strip('/')
+    # the URL only holds the values as text, so their text is the cache key
+    # (an _id may be a sub-document, which can't be hashed)
+    items = tuple(sorted((key, str(value)) for key, value in kwargs.items()))
+    return _build_admin_url(named_route, script_name, items)
+
+# shared Jinja2 environment, built on first render so TEMPLATE_PATH can be set after import
+_jinja_env = None
+
+def _get_jinja_env():
+    """_get_jinja_env() - return the shared Jinja2 environment, creating it on first use.
+    Templates are compiled once and cached for the life of the process.
+    """
+    global _jinja_env
+    if _jinja_env is None:
+        search_path = list(TEMPLATE_PATH) + [os.path.join(os.path.dirname(__file__), 'templates')]
+        _jinja_env = Environment(loader=FileSystemLoader(search_path),
+                                 auto_reload=False,
+                                 cache_size=-1,
+                                 autoescape=True)
+        _jinja_env.globals['url_for'] = url_for
+    return _jinja_env
 
 def render_template(file_name, **kwargs):
     """render_template(filename, key1=val1, key2=val2, ...) - render a Jinja2 template
     as well as provides a convenient template hook to make it compatible with flask
     adds support for the url_for() function
     """
-    kwargs['url_for'] = url_for
-    return jinja2_template(file_name, **kwargs)
+    return _get_jinja_env().get_template(file_name).render(**kwargs)
+
+def stream_template(file_name, **kwargs):
+    """stream_template(filename, key1=val1, key2=val2, ...) - like render_template() but
+    returns the page as an iterable of chunks, Bottle sends each one as it is rendered
+    """
+    return _buffered_stream(_get_jinja_env().get_template(file_name), **kwargs)
+
+def _buffered_stream(template, **kwargs):
+    """_buffered_stream(template, **kwargs) - buffered TemplateStream of a compiled template"""
+    stream = template.stream(**kwargs)
+    stream.enable_buffering(_STREAM_BUFFER_SIZE)
+    return stream
+
+# the package level login page served by render_login()
+_LOGIN_FILENAME = os.path.join(os.path.dirname(__file__), 'login.html')
+
+@lru_cache(maxsize=8)
+def _read_login_file(login_filename):
+    """_read_login_file(login_filename) - read a login page once and keep it in memory"""
+    with open(login_filename) as fp:
+        return fp.read()
     
     
+def _require_auth(f):
+    """_require_auth(f) - decorator for Admin handlers, answers 401 unless login_check() passes"""
+    @wraps(f)
+    def decorated_function(self, *args, **kwargs):
+        if not self.login_check():
+            return abort(401)
+        return f(self, *args, **kwargs)
+    return decorated_function
+
+def _require_login(f):
+    """_require_login(f) - decorator for Admin pages, redirects to the login page unless login_check() passes"""
+    @wraps(f)
+    def decorated_function(self, *args, **kwargs):
+        if not self.login_check():
+            return redirect(url_for('admin_login'))
+        return f(self, *args, **kwargs)
+    return decorated_function
+
+
 class Admin:
     """
     Allow for CRUD of data in database
@@ -107,17 +357,35 @@ class Admin:
                  admin_database='bottle_admin',
                  users_collection='bottle_users',
                  require_authentication=True,
+                 pbkdf2_rounds=None,
                  ):
-        """__init__() - initialize the administration area"""
+        """__init__() - initialize the administration area
+        pbkdf2_rounds - rounds used to hash new passwords, if None they
+                        are tuned to take about 50ms on this machine
+        """
         global _db, _app
         _app = app # global access to app
         
+        if pbkdf2_rounds is None:
+            pbkdf2_rounds = tune_password_rounds()
+        set_password_rounds(pbkdf2_rounds)
+        
         self.app = app
         self.url_prefix = url_prefix
         self.users_collection = users_collection
         
         self.require_authentication = require_authentication
         self.session = session
+        
+        # collection names, loaded on first use and reset when collections are added or dropped
+        self._collections_cache = None
+        self._collections_lock = threading.Lock()
+        
+        # (expires, '_meta' schema document) by collection name, reset when a schema is saved
+        self._schema_cache = {}
+        
+        # compiled admin templates by file name, see _template()
+        self._templates = {}
             
         ### set up the database ###
         if db_uri:
@@ -129,8 +397,15 @@ class Admin:
             
         app.db = app.client[admin_database]
         _db = app.db
+        # the users collection of this Admin, the user methods go through it
+        self._users = app.db[users_collection]
+        # MontyDB lacks some PyMongo features (type registries, pipeline updates)
+        self._native_mongo = isinstance(app.client, MongoClient)
         
         ### Add the routes ###
+        # Bottle's router already keeps static paths in a dict and matches the dynamic
+        # <coll>/<id> paths with one combined regex, so the routes stay individually
+        # named (url_for needs the names) rather than going through a catch-all.
         app.route(path=url_prefix + '/login',
                   method=['GET', 'POST'],
                   callback=self.login,
@@ -182,6 +457,21 @@ class Admin:
             method=['GET', 'POST'],
         )
         
+        _compile_url_rules(route for route in app.routes
+                           if getattr(route.callback, '__self__', None) is self)
+        
+        ### index the fields used for lookups ###
+        # each index on its own, older databases may hold duplicate '_meta' names
+        # which fail the unique build, lookups still work without the index
+        try:
+            app.db['_meta'].create_index('name', unique=True)
+        except OperationFailure:
+            pass
+        try:
+            self._users.create_index('username', unique=True)
+        except OperationFailure:
+            pass
+        
         
     def login(self, filename=None, next=None):
         """
@@ -216,22 +506,26 @@ class Admin:
             :param user: the user to login
         """
         self.session.connect()
-        self.session.data['is_authenticated'] = True
-        self.session.data['user'] = user
+        self.session.data.update({'is_authenticated': True, 'user': user})
         self.session.save()
+        request.environ[_AUTH_ENVIRON_KEY] = user
         
         
     def login_check(self):
         """
         login_check() - if require_authentication return user else None
+            the answer is kept for the rest of the request
         """
-        if self.require_authentication:
-            self.session.connect()
-            if self.session.data.get('is_authenticated'):
-                return self.session.data['user']
-            return None
-        else:
+        if not self.require_authentication:
+            # never touch the session
             return True
+        user = request.environ.get(_AUTH_ENVIRON_KEY, _MISSING)
+        if user is _MISSING:
+            self.session.connect()
+            data = self.session.data
+            user = data.get('user') if data.get('is_authenticated') else None
+            request.environ[_AUTH_ENVIRON_KEY] = user
+        return user
         
     
     def login_required(self, f):
@@ -264,54 +558,71 @@ class Admin:
         if 'user' in self.session.data:   
             self.session.data.pop('user')
         self.session.save()
+        request.environ.pop(_AUTH_ENVIRON_KEY, None)
     
     
+    @_require_login
     def view_all(self):
         """
         view_all() - view all collections in the database
         """
-        if not self.login_check():
-            return redirect(self.app.get_url('admin_login'))
-        collections = self.app.db.list_collection_names()
-        return render_template('admin/view_all.html', collections=collections )
+        collections = sorted(self._collection_names())
+        return self._render('view_all.html', collections=collections, schemas=self._get_schemas(collections))
     
+    @_require_login
     def view_collection(self, coll):
         """view_all(coll) - view a specific collection in the database"""
-        if not self.login_check():
-            return redirect(url_for('admin_login'))        
-        data = list(self.app.db[coll].find())
-        schema = self.app.db['_meta'].find_one({'name':coll})
-        # santize id to string
-        for doc in data:
-            doc['_id'] = str(doc['_id'])
-    
-        if schema:
-            # check for list-view
-            if '^' in schema['schema']:
-                docs = []
-                for raw_doc in data:
-                    this_doc = _schema_transform(raw_doc, schema)
-                    docs.append(this_doc)
-                return render_template('admin/view_collection_list.html', docs=docs, coll=coll)
+        schema = self._get_schema(coll)
+        page = _query_int('page', 1)
+        per_page = min(_query_int('per_page', _VIEW_PAGE_SIZE), _VIEW_MAX_PAGE_SIZE)
+        
+        # check for list-view, it only shows schema fields so only fetch those
+        list_view = bool(schema) and '^' in schema['schema']
+        projection = None
+        if list_view:
+            templates = _parse_schema(schema)
+            projection = {path[0]: 1 for _, path, _, _ in templates if path[0]}
+        
+        skip = (page - 1) * per_page
+        if self._native_mongo:
+            # the driver decodes ids to strings, hand the cursor to the template as-is
+            # keep the client's own codec settings (tz_aware, uuidRepresentation, ...)
+            collection = self.app.db[coll]
+            codec_options = collection.codec_options.with_options(type_registry=_STR_ID_REGISTRY)
+            collection = collection.with_options(codec_options=codec_options)
+            count = collection.estimated_document_count()
+            data = collection.find({}, projection).skip(skip).limit(per_page).batch_size(_VIEW_BATCH_SIZE)
+            page_count = max(1, -(-count // per_page))
+        else:
+            # MontyDB counts by reading every document, fetch one extra instead to
+            # know if there is a next page and leave the total out
+            count = None
+            data = list(_str_ids(self.app.db[coll].find({}, projection).skip(skip).limit(per_page + 1)))
+            page_count = page + 1 if len(data) > per_page else page
+            del data[per_page:]
+        
+        pages = {'page': page, 'per_page': per_page, 'count': count, 'pages': page_count}
+        if list_view:
+            docs = [_schema_transform(raw_doc, schema, templates) for raw_doc in data]
+            return self._render('view_collection_list.html', docs=docs, coll=coll, **pages)
     
-        return render_template('admin/view_collection.html', coll=coll, data=data, schema=schema)    
+        return self._stream('view_collection.html', coll=coll, data=data, schema=schema, **pages)
 
 
+    @_require_auth
     def edit_json(self, coll, id):
         """render a specific record as JSON"""
-        if not self.login_check():
-            return abort(401)        
-        try:
-            key = {'_id': ObjectId(id)}
-            data = self.app.db[coll].find_one(key)
-        except Exception as e:
-            return jsonify({'status': 'error', 'message': 'Admin edit_json() key, ' + str(e)})
+        oid = _to_oid(id)
+        if oid is None:
+            return abort(400, 'bad id')
+        key = {'_id': oid}
         
         if request.method == 'POST':
             try:
-                raw = dict(request.forms)
-                text_format = raw.get('content')
-                data = json.loads(text_format)
+                text_format = request.forms.getunicode('content')
+                data = _loads(text_format)
+                # the id is shown for reference, the document keeps the one in the url
+                data.pop('_id', None)
                 #self.app.db[coll].update_one(key, {'$set': data})
                 self.app.db[coll].replace_one(key, data)
             except Exception as e:
@@ -320,56 +631,49 @@ class Admin:
             return redirect( url_for('admin_view_collection', coll=coll) )
         
         else:
-            # render the JSON
-            if '_id' in data:
-                data.pop('_id')
-            return render_template('admin/edit_json.html', coll=coll, content=json.dumps(data), error=None)
+            # render the JSON, _dumps() keeps the BSON types so saving doesn't turn them into strings
+            data = self.app.db[coll].find_one(key)
+            return self._render('edit_json.html', coll=coll, content=_dumps(data), error=None)
         
 
+    @_require_auth
     def edit_fields(self, coll, id):
         """
         edit_fields('collectionName', id) - render a specific record as fields
         ** combine with edit_schema() during refactor
         """
-        if not self.login_check():
-            return abort(401)
         if not id == 'new':
-            try:
-                key = {'_id': ObjectId(id)}
-            except Exception as e:
-                return jsonify({'status': 'error', 'message': f'Admin edit_fields(), id={id}, ' + str(e)})
+            oid = _to_oid(id)
+            if oid is None:
+                return abort(400, 'bad id')
+            key = {'_id': oid}
         
         if request.method == 'POST':
             # write the data
             try:
-                if id == 'new':
-                    old_data = {}
-                else:
-                    # get existing data
-                    old_data = self.app.db[coll].find_one(key)
-                    
-                # expand from flattened to nested
-                data = expand_fields(request.forms)
-                
-                # check which fields changed
-                for k,v in old_data.items():
-                    if k not in data.keys():
-                        data[k] = ''
-                
-                # clean up
-                if '_id' in data:
-                    data.pop('_id')
-                if 'csrf_token' in data:
-                    data.pop('csrf_token')
+                # expand from flattened to nested, leaving out the id and csrf token
+                data = expand_fields(request.forms, _FORM_STRIP)
                 
                 if id == 'new':
                     # write new data
                     self.app.db[coll].insert_one(data)
+                elif self._native_mongo:
+                    # write existing data in one round-trip, the server blanks the
+                    # fields which are not in the form and lays the form data over them
+                    self.app.db[coll].update_one(key, [{'$replaceWith': {'$mergeObjects': [
+                        {'$arrayToObject': {'$map': {'input': {'$objectToArray': '$$ROOT'},
+                                                     'in': {'k': '$$this.k', 'v': ''}}}},
+                        {'_id': '$_id'},
+                        {'$literal': data},
+                    ]}}])
                 else:
+                    # get existing data, check which fields changed
+                    old_data = self.app.db[coll].find_one(key)
+                    for k in old_data.keys():
+                        if k not in data and k != '_id':
+                            data[k] = ''
                     # write existing data
                     self.app.db[coll].update_one(key, {'$set': data})
-                    
-                data['_id'] = id
             except Exception as e:
                 return jsonify({'status': 'error', 'message': 'Admin edit_fields() update_one, ' + str(e)})
             
@@ -383,9 +687,10 @@ class Admin:
             except Exception as e:
                 return jsonify({'status': 'error', 'message': 'Admin edit_fields(), find_one(), view ' + str(e)})
             
-            return render_template('admin/edit_fields.html', coll=coll, fields=fields, id=data['_id'])
+            return self._render('edit_fields.html', coll=coll, fields=fields, id=data['_id'])
 
     
+    @_require_auth
     def edit_schema(self, coll, id='new'):
         """
         edit_schema('collectionName', id) - edit collection item with based on a schema
@@ -395,127 +700,215 @@ class Admin:
         
         supports GET and POST methods
         """
-        if not self.login_check():
-            return abort(401)
         
         if id=='new':
             data = {'_id': 'new'}
         else:
-            try:
-                key = {'_id': ObjectId(id)}
-            except Exception as e:
-                return jsonify({'status': 'error', 'message': 'Admin edit_schema(), key error, ' + str(e)})
+            oid = _to_oid(id)
+            if oid is None:
+                return abort(400, 'bad id')
+            key = {'_id': oid}
         
         # view the data
         try:
-            schema = self.app.db['_meta'].find_one({'name':coll})
-            if not id == 'new':
+            if id == 'new':
+                schema = self._get_schema(coll)
+            else:
                 # get existing record
-                data = self.app.db[coll].find_one(key)
+                schema, data = self._get_schema_and_doc(coll, key)
             fields = _schema_transform(data, schema)
             data['_id'] = str(data['_id'])
         except Exception as e:
             return jsonify({'status': 'error', 'message': 'Admin edit_schema(), view ' + str(e)})
         
-        return render_template('admin/edit_schema.html', coll=coll, fields=fields, id=data['_id'])
+        return self._render('edit_schema.html', coll=coll, fields=fields, id=data['_id'])
  
         
+    @_require_auth
     def add_collection_item(self, coll):
         """Add a new item to the collection, raw JSON"""
-        if not self.login_check():
-            return abort(401)        
         if request.method == 'GET':    
-            return render_template('admin/add_json.html', coll=coll)
+            return self._render('add_json.html', coll=coll)
         else:
             raw = request.forms.get('content')
             try:
-                data = json.loads(raw)
+                data = _loads(raw)
             except:
                 data = cook_data(raw)
             self.app.db[coll].insert_one(data)
             data['_id'] = str(data['_id'])
+            # the insert creates the collection when it is new
+            self._collections_cache = None
         return redirect( url_for('admin_view_collection', coll=coll) )
   
     
+    @_require_auth
     def add_mod_collection(self, coll=None):
         """Add or Modify a collection name (and Schema)"""
-        if not self.login_check():
-            return abort(401)        
         fields = {}
-        key = None
         if coll:
             # find record of schema
             fields['name'] = coll
-            rec = self.app.db['_meta'].find_one({'name':coll})
+            rec = self._get_schema(coll)
             if rec:
-                key = {'_id': rec['_id']}
                 fields['schema'] = rec['schema']
             
         if request.method == 'POST':
-            fields = dict(request.forms)
-            name = fields.get('name')
+            name = request.forms.getunicode('name')
             if name is None:
                 return redirect( url_for('admin_view_all') )
             
-            schema = fields.get('schema')
+            schema = request.forms.getunicode('schema')
             meta = {'name': name, 'schema': schema}
             if schema:
-                if key:
-                    # since it exists, replace
-                    self.app.db['_meta'].replace_one(key, meta)
-                else:
-                    # it's new insert
-                    self.app.db['_meta'].insert_one(meta)
+                # one schema record per name, replace it or insert it if it's new
+                self.app.db['_meta'].replace_one({'name': name}, meta, upsert=True)
+                self._schema_cache.pop(name, None)
+                self._schema_cache.pop(coll, None)
                 
             # create the collection if it doesn't exist
-            if not name in self.app.db.list_collection_names():
-               id = self.app.db[name].insert_one({}).inserted_id
-               self.app.db[name].delete_one({'_id':id})
+            if not name in self._collection_names():
+                try:
+                    self.app.db.create_collection(name)
+                except (CollectionInvalid, MontyCollectionInvalid):
+                    # created elsewhere since the names were cached
+                    pass
+                self._collections_cache = None
             
             return redirect( url_for('admin_view_all') )
         
-        return render_template('admin/add_mod_collection.html', fields=fields)
+        return self._render('add_mod_collection.html', fields=fields)
     
     
+    @_require_auth
     def delete_collection_item(self, coll, id):
-        if not self.login_check():
-            return abort(401)        
-        try:
-            key = {'_id': ObjectId(id)}
-            old_data = self.app.db[coll].find_one(key)
-        except Exception as e:
-            return jsonify({'status': 'error', 'message': 'deleteJSON non-existent id, ' + str(e)})
-    
-        self.app.db[coll].delete_one(key)
+        oid = _to_oid(id)
+        if oid is None:
+            return abort(400, 'bad id')
+        self.app.db[coll].delete_one({'_id': oid})
         return redirect( url_for('admin_view_collection', coll=coll) )
     
     
+    @_require_auth
     def delete_collection_prompt(self, coll):
         """delete collection with prompt"""
-        if not self.login_check():
-            return abort(401)        
         fields = {}
         if request.method == 'POST':
-            fields = dict(request.forms)
-            if fields.get('name') == coll and fields.get('agree') == 'on':
+            if request.forms.getunicode('name') == coll and request.forms.get('agree') == 'on':
                 self.app.db[coll].drop()
+                self._collections_cache = None
             return redirect( url_for('admin_view_all') )
                 
-        return render_template('admin/delete_collection_prompt.html', fields=fields, coll=coll)
+        return self._render('delete_collection_prompt.html', fields=fields, coll=coll)
     
     
+    @_require_auth
     def delete_collection(self, coll):
         """DANGER -- this method will delete a collection immediately"""
-        if not self.login_check():
-            return abort(401)        
         self.app.db[coll].drop()
+        self._collections_cache = None
         return redirect( url_for('admin_view_all') )
    
     
+    def _template(self, file_name):
+        """_template(file_name) - the compiled admin/ template, looked up once per Admin"""
+        template = self._templates.get(file_name)
+        if template is None:
+            template = self._templates[file_name] = _get_jinja_env().get_template('admin/' + file_name)
+        return template
+    
+    
+    def _render(self, file_name, **kwargs):
+        """_render(file_name, **kwargs) - render an admin/ template"""
+        return self._template(file_name).render(**kwargs)
+    
+    
+    def _stream(self, file_name, **kwargs):
+        """_stream(file_name, **kwargs) - stream an admin/ template, see stream_template()"""
+        return _buffered_stream(self._template(file_name), **kwargs)
+    
+    
+    def _collection_names(self):
+        """_collection_names() - set of collection names in the database (cached for a few seconds)"""
+        now = time.monotonic()
+        with self._collections_lock:
+            cached = self._collections_cache
+            if cached is None or cached[0] < now:
+                cached = self._collections_cache = (now + _COLLECTIONS_TTL,
+                                                    frozenset(self.app.db.list_collection_names()))
+            return cached[1]
+    
+    
+    def _get_schema(self, coll):
+        """_get_schema(coll) - the '_meta' schema document of a collection or None (cached)"""
+        schema = self._cached_schema(coll)
+        if schema is _MISSING:
+            schema = self._cache_schema(coll, self.app.db['_meta'].find_one({'name':coll}))
+        return schema
+    
+    
+    def _get_schemas(self, colls):
+        """_get_schemas(colls) - {coll: schema document or None} of many collections,
+        the ones not cached yet are fetched together in one query
+        """
+        schemas = {coll: self._cached_schema(coll) for coll in colls}
+        missing = [coll for coll, schema in schemas.items() if schema is _MISSING]
+        if missing:
+            found = {rec['name']: rec for rec in self.app.db['_meta'].find({'name': {'$in': missing}})}
+            for coll in missing:
+                schemas[coll] = self._cache_schema(coll, found.get(coll))
+        return schemas
+    
+    
+    def _cached_schema(self, coll):
+        """_cached_schema(coll) - the cached schema document of a collection (maybe None),
+        _MISSING when it isn't cached or has expired
+        """
+        cached = self._schema_cache.get(coll)
+        if cached is None or cached[0] < time.monotonic():
+            return _MISSING
+        return cached[1]
+    
+    
+    def _cache_schema(self, coll, schema):
+        """_cache_schema(coll, schema) - remember the schema document of a collection for a few seconds"""
+        # re-add an expired entry at the end so it is evicted last
+        self._schema_cache.pop(coll, None)
+        if len(self._schema_cache) >= _SCHEMA_CACHE_SIZE:
+            # evict the oldest entry
+            self._schema_cache.pop(next(iter(self._schema_cache)), None)
+        self._schema_cache[coll] = (time.monotonic() + _SCHEMA_TTL, schema)
+        return schema
+    
+    
+    def _get_schema_and_doc(self, coll, key):
+        """
+        _get_schema_and_doc(coll, key) - the schema of a collection and the document
+        matching key, in one round-trip when the schema is not cached yet (MongoDB only,
+        a collection without a schema takes two)
+        """
+        if self._native_mongo and self._cached_schema(coll) is _MISSING:
+            pipeline = [{'$match': {'name': coll}},
+                        {'$lookup': {'from': coll, 'pipeline': [{'$match': key}], 'as': 'doc'}}]
+            schema = next(self.app.db['_meta'].aggregate(pipeline), None)
+            if schema is None:
+                # no schema for the collection, remember that and fetch the document alone
+                self._cache_schema(coll, None)
+                return None, self.app.db[coll].find_one(key)
+            docs = schema.pop('doc')
+            self._cache_schema(coll, schema)
+            return schema, docs[0] if docs else None
+        return self._get_schema(coll), self.app.db[coll].find_one(key)
+    
+    
     def unit_tests(self):
         """simple test of connectivity.  more tests should be included in separate module"""
         name = '__test_collection'
-        _id = self.app.db[name].insert_one({}).inserted_id
+        try:
+            self.app.db.create_collection(name)
+        except (CollectionInvalid, MontyCollectionInvalid):
+            # left over from an earlier run
+            pass
         names = self.app.db.list_collection_names()
         assert(name in names)
         self.app.db[name].drop()
@@ -524,9 +917,7 @@ class Admin:
     
     def get_users(self):
         """get_users() - return a list of all users JSON records"""
-        if _db is None:
-            raise ValueError("Database not initialized!")
-        return list(_db[self.users_collection].find())
+        return list(self._users.find())
     
     
     def get_user(self, username=None, uid=None):
@@ -535,14 +926,15 @@ class Admin:
         : param {uid} : - a specific user id (string) - note, this is actual '_id' in databse
         : return : a user record or None if not found
         """
-        if _db is None:
-            raise ValueError("Database not initialized!")
         # first try the username--
         user = None
         if username:
-            user = _db[self.users_collection].find_one({'username': username})
+            user = self._users.find_one({'username': username})
         if uid:
-            user = _db[self.users_collection].find_one({'_id':uid})
+            # ids are stored as ObjectId, a string id would never match
+            if isinstance(uid, str):
+                uid = _to_oid(uid) or uid
+            user = self._users.find_one({'_id':uid})
         return user
     
     
@@ -564,7 +956,7 @@ class Admin:
         for key, value in kwargs.items():
             user[key] = value
     
-        _db[self.users_collection].insert_one(user)
+        self._users.insert_one(user)
         return True
     
     
@@ -582,16 +974,23 @@ class Admin:
         """
         user = self.get_user(username)
         if user:
-            idx = {'_id': user['_id']}
+            # collect all changes so the record is written in one update
+            sets, unsets = {}, {}
             for key, value in kwargs.items():
                 if value is None and key in user:
                     # delete the key
-                    _db[self.users_collection].update_one(idx, {'$unset': {key:""}} )
+                    unsets[key] = ""
                 else:
-                   # user[key] = value
                     if key=='password':
                         value = encrypt_password(value)
-                    _db[self.users_collection].update_one(idx, {'$set': {key:value}} )
+                    sets[key] = value
+            op = {}
+            if sets:
+                op['$set'] = sets
+            if unsets:
+                op['$unset'] = unsets
+            if op:
+                self._users.update_one({'_id': user['_id']}, op)
             return True
         return False
     
@@ -608,7 +1007,7 @@ class Admin:
         if uid:
             user = self.get_user(uid=uid)
         if user:
-            _db[self.users_collection].remove(user)
+            self._users.delete_one({'_id': user['_id']})
         return user
     
     
@@ -621,7 +1020,17 @@ class Admin:
         """
         user = self.get_user(username)
         if user:
-            if check_encrypted_password(password, user['password']):
+            hashed = user['password']
+            key = _verify_key(username, password)
+            if _is_verified(key, hashed):
+                return True
+            if check_encrypted_password_fast(password, hashed):
+                if pwd_context.needs_update(hashed):
+                    # rehash with the current rounds while we have the plain-text
+                    hashed = encrypt_password(password)
+                    self._users.update_one({'_id': user['_id']}, {'$set': {'password': hashed}})
+                # remember the hash that is stored now, so the next login hits the cache
+                _remember_verified(key, hashed)
                 return True
         return False
     
@@ -638,13 +1047,18 @@ class Admin:
         """
         # use module level 'login.html''
         if login_filename is None:
-            moduledir = os.path.dirname(__file__)
-            login_filename = os.path.join(moduledir, 'login.html')
+            login_filename = _LOGIN_FILENAME
         if not isinstance(login_filename, str):
             raise TypeError("ERROR: minmus_users.login_page() - login_filename must be a string")
-        with open(login_filename) as fp:
-            data = fp.read()
-        return data
+        return _read_login_file(login_filename)
+    
+    
+    def reload_login_template(self):
+        """
+        reload_login_template() - forget the cached login pages so the next
+        render_login() reads them from disk again (useful while editing them)
+        """
+        _read_login_file.cache_clear()
     
     
     def user_services_cli(self, args):
@@ -742,60 +1156,39 @@ Other operations:
         print(usage)
         return False
 
-def _merge_dicts(dict1, dict2):
-    """ 
-    _merge_dicts(dict1, dict2) - merge two dictionaries, return the union.
-    Using yield increases efficiency.
-    From
+def expand_fields(fields, exclude=()):
     """
-    for k in set(dict1.keys()).union(dict2.keys()):
-        if k in dict1 and k in dict2:
-            if isinstance(dict1[k], dict) and isinstance(dict2[k], dict):
-                # unfortunately, a recursive call
-                yield (k, dict(_merge_dicts(dict1[k], dict2[k])))
-            else:
-                # If one of the values is not a dict, you can't continue merging it.
-                # Value from second dict overrides one in first and we move on.
-                yield (k, dict2[k])
-                # Alternatively, replace this with exception raiser to alert you of value conflicts
-        elif k in dict1:
-            yield (k, dict1[k])
-        else:
-            yield (k, dict2[k])
-    
-def expand_fields(fields):
-    """
-    expand_fields(fields) - expand flattened fields to nested fields
+    expand_fields(fields, exclude=()) - expand flattened fields to nested fields
     : params data - a flattened record
+    : params exclude - field names to leave out
     returns expanded fields
     """
     data = {}
     for name, value in fields.items():
-        data = dict( _merge_dicts(data, _nest_value(name, value)) )
+        if name not in exclude:
+            _nest_value(data, name, value)
     return data
 
-def _nest_value(name, value):
+def _nest_value(data, name, value):
     """
-    _nest_value(name, value) - put the fields from a 
-    "flattened" dotted name into nested structure and return
+    _nest_value(data, name, value) - put the value of a
+    "flattened" dotted name into the nested structure data
     
+    :param data - the nested dictionary to update
     :param name - the flattened dotted name
     :param value - the actual value
     
-    return nested_value
-    
-    How can I do this cleaner with a dict structure?
+    return data
     """
-    data = {}
     parts = name.strip().split('.')
-    if len(parts) == 1:
-        data.update({parts[0]:value})
-    elif len(parts) == 2:
-        data.update({parts[0]: {parts[1]:value}})
-    elif len(parts) == 3:
-        data.update( {parts[0]: { parts[1] : { parts[2] : value } } } )
-    else:
-        raise ValueError("Schmema depth exceeds maximum limit of 3")
+    d = data
+    for part in parts[:-1]:
+        nxt = d.get(part)
+        if not isinstance(nxt, dict):
+            nxt = {}
+            d[part] = nxt
+        d = nxt
+    d[parts[-1]] = value
     return data
     
 
@@ -806,7 +1199,15 @@ def _get_nested_value(name, data):
     :param data - data dictionary of document
     return value
     """
-    parts = name.strip().split('.')
+    return _get_path_value(name.strip().split('.'), data)
+
+def _get_path_value(parts, data):
+    """
+    _get_path_value(parts, data) - like _get_nested_value() with the dotted name already split
+    :param parts - the parts of the dotted name
+    :param data - data dictionary of document
+    return value
+    """
     value = data
     for part in parts:
         value = value.get(part, '')
@@ -814,12 +1215,69 @@ def _get_nested_value(name, data):
             return value
     return None
 
-def _schema_transform(data, schema):
-    """_schema_transform(data, schema) - create fields from data document and schema. These
+def _path_getter(parts):
+    """_path_getter(parts) - function of a document returning _get_path_value(parts, document),
+    a single name skips the walk
+    """
+    if len(parts) == 1:
+        key = parts[0]
+        def get(data):
+            value = data.get(key, '')
+            return None if isinstance(value, dict) else value
+        return get
+    return lambda data: _get_path_value(parts, data)
+
+def _parse_schema(schema):
+    """_parse_schema(schema) - parse the schema buffer into field templates
+    (see _schema_transform() for the format).
+
+    :param schema - the document schema
+    
+    return
+        tuple of (field, path, default, get) - field is the template for the form field,
+        path is the dotted name already split, default is the schema default value,
+        get(document) returns the value of the field in a document
+        the templates are shared, copy a field before changing it
+    """
+    return _parse_schema_text(schema.get('schema'))
+
+# splits a schema line on ':', taking the blanks around each ':' with it
+_SCHEMA_SPLIT = re.compile(r'[ \t]*:[ \t]*')
+
+@lru_cache(maxsize=256)
+def _parse_schema_text(text):
+    """_parse_schema_text(text) - parse a schema buffer, memoized on its text
+    so a schema is only parsed again after it has been edited
+    """
+    # grab the schema buffer, one field per non-blank line
+    return tuple([_build_field(line) for line in map(str.strip, text.split('\n')) if line])
+
+def _build_field(line):
+    """_build_field(line) - (field, path, default, get) template of one stripped schema line"""
+    # break it on ':' into name, control, label, type, default (missing parts are '')
+    parts = _SCHEMA_SPLIT.split(line, 4)
+    parts += [''] * (5 - len(parts))
+    name, control, label, ftype, default = parts
+    
+    # is it a list-view field? is it a required field?
+    field = {'list-view': '^' in name, 'required': '*' in name}
+    name = name.replace('^', '').replace('*', '').strip()
+    field['name'] = name
+    field['control'] = control
+    field['label'] = label if label else name.title()
+    field['type'] = ftype
+    
+    path = tuple(name.split('.'))
+    return field, path, default, _path_getter(path)
+
+def _schema_transform(data, schema, templates=None):
+    """_schema_transform(data, schema, templates=None) - create fields from data document and schema. These
     fields are used to create a form for editing the document. The fields are ordered.
 
     :param data - the document data
     :param schema - the document schema
+    :param templates - the result of _parse_schema(schema), pass it in when
+                       transforming many documents with the same schema
     
     return
         fields
@@ -843,56 +1301,30 @@ def _schema_transform(data, schema):
     type (simple types only)
     
     """
-    # grab the schema buffer
-    schema_lines = schema.get('schema').split('\n')
-    fields = []
-    for line in schema_lines:
-        if line:
-            field = {}
-            
-            # if there is an '_id' field, then this is an existing document
-            if '_id' in data:
-                field.update({'_id': data['_id']})
-                
-            # break it on ':'
-            parts = line.split(':')
-            
-            # name part
-            
-            # is it a list-view field?
-            field['list-view'] = '^' in parts[0]
-            parts[0] = parts[0].replace('^', '')
-            
-            # is it a required field?
-            field['required'] = '*' in parts[0]
-            parts[0] = parts[0].replace('*', '')
-            
-            field['name'] = parts[0].strip() # the name part
-            
-            field['control'] = parts[1].strip() # get the type
-            
-            if len(parts) > 2: 
-                field['label'] = parts[2].strip() # the label
-            else:
-                field['label'] = field['name'].title()
-                
-            if len(parts) > 3:
-                field['type'] = parts[3].strip()
-            
-            # value for field(data) is none, get it from schema
-            if data == {}:
-                if len(parts) > 4:
-                    field['value'] = parts[4].strip()
-                else:
-                    # if value is missing, make it an empty string
-                    field['value'] = ''
-            else:
-                # transform multiple depths
-                value = _get_nested_value(field['name'], data)
-                field['value'] = value
-                
-            fields.append(field)
-    return fields
+    if templates is None:
+        templates = _parse_schema(schema)
+    # an empty document takes its values from the schema defaults
+    use_defaults = not data
+    # if there is an '_id' field, then this is an existing document
+    base = {'_id': data['_id']} if '_id' in data else {}
+    # transform multiple depths
+    return [{**base, **template, 'value': default if use_defaults else get(data)}
+            for template, _, default, get in templates]
+
+def _query_int(name, default):
+    """_query_int(name, default) - positive integer query parameter of the request or default"""
+    try:
+        value = int(request.query.get(name, default))
+    except ValueError:
+        return default
+    return value if value > 0 else default
+
+def _str_ids(docs):
+    """_str_ids(docs) - yield each document with its '_id' sanitized to a string"""
+    _str = str
+    for doc in docs:
+        doc['_id'] = _str(doc['_id'])
+        yield doc
 
 def _unflatten(dictionary, separator='.'):
     """
@@ -933,17 +1365,13 @@ def _fields_transform(fields):
     """transform fields to be used in form"""
     # flatten dictionary if needed
     f_fields = _flatten_dict(fields)
+    _str = str
     nfields = []
+    _append = nfields.append
     for key, value in f_fields.items():
-        nf = {}
-        nf['name'] = key
-        nf['value'] = str(value)
-        nf['label'] = key.capitalize()
-        if '\n' in nf['value']:
-            nf['type'] = 'textarea'
-        else:
-            nf['type'] = 'text'
-        nfields.append(nf)
+        value = _str(value)
+        _append({'name': key, 'value': value, 'label': key.capitalize(),
+                 'type': 'textarea' if '\n' in value else 'text'})
     return nfields
 
 
@@ -952,10 +1380,10 @@ def cook_data(raw_data):
     data = {}
     lines = raw_data.split('\n')
     for line in lines:
-        if ':' in line:
-            key, value = line.split(':')
-            key = key.strip()
-            data[key] = value.strip()
+        # split at the first colon only, the value may hold more
+        key, sep, value = line.partition(':')
+        if sep:
+            data[key.strip()] = value.strip()
     return data
 
 if __name__ == '__main__':